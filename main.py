@@ -1,29 +1,50 @@
 
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import os
 import json
+import asyncio
+import functools
+import shutil
+import hashlib
+import uuid
 from fastapi import FastAPI, Request, UploadFile, File, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 import pandas as pd
+import numpy as np
+import joblib
+import scipy.sparse
 from contextlib import asynccontextmanager
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.pipeline import Pipeline
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="[%(asctime)s] [%(levelname)s] [%(name)s:%(funcName)s] %(message)s",
-    handlers=[
-        logging.FileHandler("logs/app.log"),
-        logging.StreamHandler()
-    ]
-)
+# リクエスト処理中はキューに積むだけにし、ファイル・標準出力への書き込みはQueueListenerのスレッドで行う
+log_formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(name)s:%(funcName)s] %(message)s")
+file_handler = logging.FileHandler("logs/app.log")
+file_handler.setFormatter(log_formatter)
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(log_formatter)
+
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(QueueHandler(log_queue))
 logger = logging.getLogger(__name__)
 
 UPLOAD_DIR = "uploads"
+CACHE_DIR = "cache" # 解析済みデータとTF-IDFモデルの保存先（再起動後も再利用する）
+CACHE_FORMAT_VERSION = 3 # ベクトル化の設定や保存形式を変更した場合は値を上げ、古い保存データを使わないようにする
+CACHE_MAX_ENTRIES = 20 # 保存しておく解析結果の最大数（古いものから削除）
 CONFIG_FILE = "config.json"
+UPLOAD_CHUNK_SIZE = 1024 * 1024 # アップロードファイルを書き込む際のチャンクサイズ(1MB)
+HASHING_N_FEATURES = 2 ** 18 # 文字n-gramをハッシュする次元数
+GROUP_FULL_SCAN_RATIO = 0.5 # 画面名称の行数が全体のこの割合以上なら、スライスせず全件の類似度をマスクして使う
 
 # --- Global Config ---
 # 設定ファイルから読み込んだ設定を保持します。
@@ -35,12 +56,23 @@ config = {
 # --- In-memory Cache ---
 # アプリケーションのパフォーマンス向上のため、読み込んだデータとTF-IDFモデルをメモリにキャッシュします。
 # 新しいファイルがアップロードされると、このキャッシュはクリアされます。
-cache = {
-    "filepath": None, # キャッシュされたファイルのパス
-    "df": None,       # pandasデータフレーム
-    "vectorizer": None, # TfidfVectorizerオブジェクト
-    "matrix": None      # TF-IDFマトリクス
-}
+def _create_empty_cache():
+    return {
+        "filepath": None, # キャッシュされたファイルのパス（アップロード時に設定）
+        "mtime": None,    # キャッシュ作成時のファイル更新時刻(st_mtime_ns)
+        "df": None,       # pandasデータフレーム
+        "vectorizer": None, # ベクトル化パイプライン(HashingVectorizer + TfidfTransformer)
+        "matrix": None,     # TF-IDFマトリクス
+        "group_indices": {},  # 画面名称ごとの行位置(numpy配列)
+        "group_matrices": {}, # 行数の少ない画面名称ごとにスライス済みのTF-IDFマトリクス
+        "group_masks": {},    # 行数の多い画面名称ごとの行マスク(全件の類似度に適用する)
+        "functional_areas": None, # 画面名称の一覧（機能名ドロップダウン用）
+        "area_query_vectors": {}  # 画面名称をキーワードとした場合のベクトル化済みクエリ
+    }
+
+cache = _create_empty_cache()
+# キャッシュの確認・読み込みを排他制御するためのロック
+_cache_lock = asyncio.Lock()
 # ----------------------
 
 def load_config():
@@ -51,30 +83,34 @@ def load_config():
     try:
         with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
             config = json.load(f)
-        logger.info(f"Successfully loaded config from {CONFIG_FILE}")
+        logger.info("Successfully loaded config from %s", CONFIG_FILE)
     except FileNotFoundError:
-        logger.error(f"Config file not found at {CONFIG_FILE}. Using default empty config.")
+        logger.error("Config file not found at %s. Using default empty config.", CONFIG_FILE)
         # config.jsonがない場合はデフォルト値（空）で続行
     except json.JSONDecodeError:
-        logger.error(f"Failed to decode JSON from {CONFIG_FILE}. Using default empty config.")
+        logger.error("Failed to decode JSON from %s. Using default empty config.", CONFIG_FILE)
         # JSONの解析に失敗した場合もデフォルト値で続行
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup event
+    log_listener.start() # ログ書き込みスレッドを開始
     logger.info("Application startup...")
     load_config() # 設定ファイルの読み込み
     if not os.path.exists(UPLOAD_DIR):
         os.makedirs(UPLOAD_DIR)
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
     # Clean up the uploads directory on startup
     for filename in os.listdir(UPLOAD_DIR):
         file_path = os.path.join(UPLOAD_DIR, filename)
         if os.path.isfile(file_path):
             os.unlink(file_path)
-    logger.info(f"Cleaned up {UPLOAD_DIR} directory.")
+    logger.info("Cleaned up %s directory.", UPLOAD_DIR)
     yield
     # Shutdown event
     logger.info("Application shutdown...")
+    log_listener.stop() # キューに残ったログを書き出してから停止
 
 app = FastAPI(
     title="Inquiry Analysis App",
@@ -83,68 +119,284 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# 静的ファイルは本番環境(ENV=production)以外ではアプリから配信する
+# 本番環境ではnginx等のリバースプロキシが /static を直接配信する（deploy/nginx.conf 参照）
+if os.getenv("ENV") != "production":
+    app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="static")
 
-def _ensure_data_is_cached():
+@functools.lru_cache(maxsize=1024)
+def _vectorize_query(vectorizer_id: int, keywords: str):
     """
-    データがキャッシュされていることを確認し、キャッシュされていない、または古い場合はデータをロードします。
+    検索キーワードをベクトル化します。同じキーワードの再検索時はキャッシュ結果を返します。
+    vectorizer_idはキャッシュキーとしてのみ使用します。idは再利用されることがあるため、
+    キャッシュ(cache["vectorizer"])を入れ替えるときは必ずcache_clear()を呼び出してください。
     """
-    global cache
-    logger.info("[_ensure_data_is_cached:start] Checking cache status.")
-    
+    return cache["vectorizer"].transform([keywords])
+
+def _get_cache_key(filepath, search_columns):
+    """
+    ファイル内容・検索対象列・ベクトル化の設定からキャッシュキー(SHA-256)を作成します。
+    同じExcelを再アップロードした場合も、保存済みの解析結果を再利用できます。
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    digest.update(json.dumps(search_columns, ensure_ascii=False).encode("utf-8"))
+    digest.update(f"v{CACHE_FORMAT_VERSION}:{HASHING_N_FEATURES}".encode("utf-8"))
+    return digest.hexdigest()
+
+def _persist_cache_file(save, path):
+    """
+    解析結果をファイルに保存します。保存に失敗しても検索自体は続行できるため、警告のみ出力します。
+    書き込み途中のファイルが残らないよう、一時ファイルに書き込んでから置き換えます。
+    保存できた場合はTrueを返します。
+    """
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.tmp-{uuid.uuid4().hex}{ext}" # save_npzが拡張子を付け足さないよう、拡張子は維持する
     try:
-        files = os.listdir(UPLOAD_DIR)
-        if not files:
-            logger.warn("[_ensure_data_is_cached:warn] No files in uploads directory. Skipping cache load.")
-            return
+        save(tmp_path)
+        os.replace(tmp_path, path)
+        return True
+    except Exception as e:
+        logger.warning("[_persist_cache_file:warn] Could not persist %s: %s", path, e)
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        return False
 
-        latest_file = max([os.path.join(UPLOAD_DIR, f) for f in files], key=os.path.getctime)
+def _load_persisted_cache(dataframe_path, vectorizer_path, matrix_path):
+    """
+    保存済みの解析結果を読み込みます。存在しない、または読み込めない場合はNoneを返します。
+    読み込めなかったファイルは削除し、次回はExcelから作り直します。
+    """
+    paths = (dataframe_path, vectorizer_path, matrix_path)
+    if not all(os.path.exists(path) for path in paths):
+        return None
+    try:
+        df = pd.read_pickle(dataframe_path)
+        vectorizer = joblib.load(vectorizer_path)
+        matrix = scipy.sparse.load_npz(matrix_path)
+    except Exception as e:
+        logger.warning("[_load_persisted_cache:warn] Could not load persisted data (%s). Rebuilding from the Excel file.", e)
+        for path in paths:
+            if os.path.exists(path):
+                os.unlink(path)
+        return None
+    # 最近使った解析結果が削除されないよう、更新時刻を更新する
+    # （読み込み後に他の処理で削除されていても、読み込んだデータはそのまま使う）
+    try:
+        for path in paths:
+            os.utime(path)
+    except OSError:
+        pass
+    return df, vectorizer, matrix
 
-        # キャッシュが最新であるか確認
-        if cache["filepath"] == latest_file and cache["df"] is not None:
-            logger.info("[_ensure_data_is_cached:success] Cache is up to date.")
+def _evict_old_cache_files():
+    """
+    保存済みの解析結果がCACHE_MAX_ENTRIESを超えた場合、最後に使われたのが古いものから削除します。
+    """
+    try:
+        last_used = {}
+        for filename in os.listdir(CACHE_DIR):
+            file_path = os.path.join(CACHE_DIR, filename)
+            cache_key = filename.split(".", 1)[0]
+            last_used[cache_key] = max(last_used.get(cache_key, 0), os.path.getmtime(file_path))
+        stale_keys = sorted(last_used, key=last_used.get, reverse=True)[CACHE_MAX_ENTRIES:]
+        if not stale_keys:
             return
-
-        logger.info(f"[_ensure_data_is_cached:info] Cache is stale or empty. Loading data from {latest_file}.")
-        
-        # --- ここから重い処理 ---
-        df = pd.read_excel(latest_file)
-        print("Excelの列名:", df.columns.tolist()) # デバッグ用に列名を出力
-        df.fillna("", inplace=True)
-
-        #print("重い処理 開始....")
-
-        search_columns = config.get("search_columns", [])
-        if not search_columns:
-            raise HTTPException(status_code=500, detail="設定ファイルに検索対象列が指定されていません。")
-
-        for col in search_columns:
-            if col not in df.columns:
-                raise HTTPException(status_code=400, detail=f'設定ファイルで指定された列 "{col}" がアップロードされたファイルに見つかりません。')
-
-        df["search_text"] = df[search_columns].apply(lambda x: ' '.join(x.astype(str)), axis=1)
-
-        vectorizer = TfidfVectorizer(analyzer='char', ngram_range=(2, 3))
+        for filename in os.listdir(CACHE_DIR):
+            if filename.split(".", 1)[0] in stale_keys:
+                os.unlink(os.path.join(CACHE_DIR, filename))
+        logger.info("[_evict_old_cache_files:info] Removed %d old cache entries.", len(stale_keys))
+    except OSError as e:
+        logger.warning("[_evict_old_cache_files:warn] Could not evict old cache entries: %s", e)
+
+def _build_cache_sync(filepath):
+    """
+    Excelファイルを読み込み、TF-IDFモデルを作成して新しいキャッシュを返します。
+    CPU・IOの重い処理のため、イベントループをブロックしないようスレッドプール上で実行されます。
+    """
+    logger.info("[_build_cache_sync:start] Loading data from %s.", filepath)
+
+    search_columns = config.get("search_columns", [])
+    if not search_columns:
+        raise HTTPException(status_code=500, detail="設定ファイルに検索対象列が指定されていません。")
+
+    # ファイル内容と検索対象列が同じであれば、保存済みの解析結果を再利用する
+    cache_key = _get_cache_key(filepath, search_columns)
+    # DataFrameはpickleで保存する（Excelでよくある数値と文字列が混在した列はParquetに書き込めないため）
+    dataframe_path = os.path.join(CACHE_DIR, f"{cache_key}.dataframe.pkl")
+    vectorizer_path = os.path.join(CACHE_DIR, f"{cache_key}.vectorizer.joblib")
+    matrix_path = os.path.join(CACHE_DIR, f"{cache_key}.matrix.npz")
+
+    # --- ここから重い処理 ---
+    persisted = _load_persisted_cache(dataframe_path, vectorizer_path, matrix_path)
+    if persisted is not None:
+        logger.info("[_build_cache_sync:info] Reusing persisted data for %s (key: %s).", filepath, cache_key)
+        df, vectorizer, matrix = persisted
+    else:
+        # openpyxl(純Python)より高速なRust製のcalamineエンジンでExcelを解析する
+        df = pd.read_excel(filepath, engine='calamine')
+    logger.debug("[_build_cache_sync:debug] Excel columns: %s", df.columns) # デバッグ用に列名を出力
+
+    #print("重い処理 開始....")
+
+    for col in search_columns:
+        if col not in df.columns:
+            raise HTTPException(status_code=400, detail=f'設定ファイルで指定された列 "{col}" がアップロードされたファイルに見つかりません。')
+
+    # 検索対象列が揃っていることを確認してから、解析したExcelを保存する
+    is_dataframe_persisted = persisted is None and _persist_cache_file(lambda path: df.to_pickle(path), dataframe_path)
+
+    # 欠損値の置換は検索対象列のみに行い、他の列は元の型（数値・日付など）のまま保持する
+    df[search_columns] = df[search_columns].fillna("")
+
+    # 行ごとのapplyではなく、列単位の文字列連結で検索用テキストを作成する
+    search_texts = [df[col].astype(str) for col in search_columns]
+    df["search_text"] = search_texts[0].str.cat(search_texts[1:], sep=' ')
+
+    # 画面名称は同じ値が繰り返されるため、カテゴリ型にしてメモリ使用量とグループ化のコストを抑える
+    # （検索対象列に含まれる場合に備え、欠損値の置換と検索用テキストの作成後に変換する）
+    if "画面名称" in df.columns:
+        df["画面名称"] = df["画面名称"].astype("category")
+
+    if persisted is None:
+        # 語彙辞書を持たないHashingVectorizerで文字n-gramを数え、TfidfTransformerでIDFを掛ける
+        # （ハッシュの衝突を除きTfidfVectorizerと同じ計算で、語彙の肥大化によるメモリ・構築時間の増加を防ぐ）
+        # norm='l2'で各行を正規化しておくことで、コサイン類似度は内積だけで求められる
+        # float32で保持し、類似度計算時に読み込むデータ量を半分にする
+        vectorizer = Pipeline([
+            ("hashing", HashingVectorizer(analyzer='char', ngram_range=(2, 3), n_features=HASHING_N_FEATURES,
+                                          alternate_sign=False, norm=None, dtype=np.float32)),
+            ("tfidf", TfidfTransformer(norm='l2')),
+        ])
         matrix = vectorizer.fit_transform(df["search_text"])
-        # --- 重い処理ここまで ---
+        # コーパスに出現しないn-gram(df=0)はIDFが最大になり、クエリのノルムを膨らませて類似度を不当に下げる
+        # TfidfVectorizerが語彙外のn-gramを無視するのと同じになるよう、それらのIDFを0にする
+        tfidf = vectorizer.named_steps["tfidf"]
+        document_frequency = np.bincount(matrix.indices, minlength=HASHING_N_FEATURES)
+        idf = tfidf.idf_.copy()
+        idf[document_frequency == 0] = 0
+        tfidf.idf_ = idf
+        if matrix.nnz <= np.iinfo(np.int32).max:
+            matrix.indices = matrix.indices.astype(np.int32, copy=False)
+            matrix.indptr = matrix.indptr.astype(np.int32, copy=False)
+        # DataFrameを保存できなかった場合は再利用できないため、vectorizerとマトリクスも保存しない
+        if is_dataframe_persisted:
+            _persist_cache_file(lambda path: joblib.dump(vectorizer, path), vectorizer_path)
+            _persist_cache_file(lambda path: scipy.sparse.save_npz(path, matrix), matrix_path)
+            _evict_old_cache_files()
+
+    # 検索のたびにフィルタリング・スライスしないよう、画面名称ごとの行位置とマトリクスを事前に作成
+    group_indices = {}
+    if "画面名称" in df.columns:
+        group_indices = {
+            area: np.asarray(indices, dtype=np.int32)
+            for area, indices in df.groupby("画面名称", observed=True).indices.items()
+        }
+    # 行数の多い画面名称はスライスしたマトリクスを持たず、全件の類似度にかけるマスクのみ作成する
+    group_matrices = {}
+    group_masks = {}
+    for area, indices in group_indices.items():
+        if indices.size >= GROUP_FULL_SCAN_RATIO * len(df):
+            mask = np.zeros(len(df), dtype=bool)
+            mask[indices] = True
+            group_masks[area] = mask
+        else:
+            group_matrices[area] = matrix[indices]
+
+    # 機能名一覧もリクエストごとに再計算しないよう、ここで作成しておく
+    functional_areas = None
+    if "画面名称" in df.columns:
+        functional_areas = df["画面名称"].dropna().unique().tolist()
+
+    # 画面名称はキーワードとしてもよく使われるため、まとめてベクトル化しておく
+    area_query_vectors = {}
+    area_names = [area for area in (functional_areas or []) if isinstance(area, str) and area]
+    if area_names:
+        area_matrix = vectorizer.transform(area_names)
+        area_query_vectors = {area: area_matrix[i] for i, area in enumerate(area_names)}
+    # --- 重い処理ここまで ---
+
+    new_cache = _create_empty_cache()
+    new_cache["filepath"] = filepath
+    new_cache["df"] = df
+    new_cache["vectorizer"] = vectorizer
+    new_cache["matrix"] = matrix
+    new_cache["group_indices"] = group_indices
+    new_cache["group_matrices"] = group_matrices
+    new_cache["group_masks"] = group_masks
+    new_cache["functional_areas"] = functional_areas
+    new_cache["area_query_vectors"] = area_query_vectors
+
+    logger.info("[_build_cache_sync:success] Data loaded successfully.")
+    return new_cache
+
+def _is_cache_fresh():
+    """
+    キャッシュがアップロード済みファイルの最新の内容で作成されているかを返します。
+    """
+    filepath = cache["filepath"]
+    if filepath is None or cache["df"] is None:
+        return False
+    try:
+        return os.stat(filepath).st_mtime_ns == cache["mtime"]
+    except OSError:
+        return False
 
-        # グローバルキャッシュを更新
-        cache["filepath"] = latest_file
-        cache["df"] = df
-        cache["vectorizer"] = vectorizer
-        cache["matrix"] = matrix
-        
-        logger.info("[_ensure_data_is_cached:success] Data loaded and cached successfully.")
+async def _ensure_data_is_cached():
+    """
+    データがキャッシュされていることを確認し、キャッシュされていない、または古い場合はデータをロードします。
+    同時に複数の検索が来ても読み込みが重複しないよう、ロック取得後に再確認してから読み込みを行います。
+    """
+    global cache
+    logger.info("[_ensure_data_is_cached:start] Checking cache status.")
 
-    except Exception as e:
-        logger.error(f"[_ensure_data_is_cached:error] Failed to load or cache data: {e}")
-        # Invalidate cache on error
-        cache = {"filepath": None, "df": None, "vectorizer": None, "matrix": None}
-        # HTTPExceptionはそのままraiseする
-        if isinstance(e, HTTPException):
-            raise
-        raise HTTPException(status_code=500, detail=f"データの読み込みまたはキャッシュ中に予期せぬエラーが発生しました: {e}")
+    # キャッシュが最新であればロックを取得せずに返す（ロック取得後にもう一度確認する）
+    if _is_cache_fresh():
+        logger.info("[_ensure_data_is_cached:success] Cache is up to date.")
+        return
+
+    async with _cache_lock:
+        filepath = cache["filepath"]
+        try:
+            if filepath is None:
+                logger.warning("[_ensure_data_is_cached:warn] No file has been uploaded. Skipping cache load.")
+                return
+
+            # ディレクトリを走査せず、アップロード済みファイルの更新時刻だけでキャッシュが最新か確認
+            mtime = os.stat(filepath).st_mtime_ns
+            if cache["df"] is not None and cache["mtime"] == mtime:
+                logger.info("[_ensure_data_is_cached:success] Cache is up to date.")
+                return
+
+            logger.info("[_ensure_data_is_cached:info] Cache is stale or empty. Loading data from %s.", filepath)
+
+            # 重い処理はスレッドプールで実行し、その間も他のリクエストを処理できるようにする
+            new_cache = await run_in_threadpool(_build_cache_sync, filepath)
+            new_cache["mtime"] = mtime
+
+            # 読み込み中に別のファイルがアップロードされた場合は、古いデータでキャッシュを上書きしない
+            if cache["filepath"] != filepath:
+                logger.info("[_ensure_data_is_cached:info] A new file was uploaded while loading. Discarding loaded data.")
+                return
+            cache = new_cache
+            # 新しいvectorizerが古いものと同じidになる場合があるため、キーワードのベクトル化結果も破棄する
+            _vectorize_query.cache_clear()
+
+            logger.info("[_ensure_data_is_cached:success] Data loaded and cached successfully.")
+
+        except Exception as e:
+            logger.error("[_ensure_data_is_cached:error] Failed to load or cache data: %s", e)
+            # Invalidate cache on error (アップロード済みファイルの情報は保持し、次回のリクエストで再読み込みする)
+            if cache["filepath"] == filepath:
+                cache = _create_empty_cache()
+                cache["filepath"] = filepath
+            # HTTPExceptionはそのままraiseする
+            if isinstance(e, HTTPException):
+                raise
+            raise HTTPException(status_code=500, detail=f"データの読み込みまたはキャッシュ中に予期せぬエラーが発生しました: {e}")
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
@@ -155,45 +407,48 @@ async def read_root(request: Request):
 async def upload_file(file: UploadFile = File(...)):
     global cache
     upload_path = os.path.join(UPLOAD_DIR, file.filename)
-    logger.info(f"[upload_file:start] Uploading file: {file.filename}")
+    logger.info("[upload_file:start] Uploading file: %s", file.filename)
     try:
+        # ファイル全体をメモリに読み込まず、スレッドプール上でチャンクごとにディスクへ書き込む
         with open(upload_path, "wb") as buffer:
-            buffer.write(await file.read())
+            await run_in_threadpool(shutil.copyfileobj, file.file, buffer, UPLOAD_CHUNK_SIZE)
         
-        # ファイルが正常にアップロードされた後、キャッシュを無効化
-        cache = {"filepath": None, "df": None, "vectorizer": None, "matrix": None}
+        # ファイルが正常にアップロードされた後、キャッシュを無効化し、次回の読み込み対象として記録
+        cache = _create_empty_cache()
+        cache["filepath"] = upload_path
+        cache["mtime"] = os.stat(upload_path).st_mtime_ns
+        _vectorize_query.cache_clear()
         logger.info("[upload_file:success] Cache invalidated due to new file upload.")
         
-        logger.info(f"[upload_file:success] File saved at: {upload_path}")
+        logger.info("[upload_file:success] File saved at: %s", upload_path)
         return {"message": f"{file.filename} のアップロードが成功しました。"}
     except Exception as e:
-        logger.error(f"[upload_file:error] Could not save file: {e}")
+        logger.error("[upload_file:error] Could not save file: %s", e)
         raise HTTPException(status_code=500, detail="ファイルのアップロード中にエラーが発生しました。")
 
 @app.get("/api/functional-areas")
 async def get_functional_areas():
     logger.info("[get_functional_areas:start] Fetching functional areas.")
-    if not os.listdir(UPLOAD_DIR):
+    if cache["filepath"] is None:
         return []
     
-    _ensure_data_is_cached() # データがキャッシュされていることを確認
+    await _ensure_data_is_cached() # データがキャッシュされていることを確認
     
-    df = cache["df"]
-    if df is None or "画面名称" not in df.columns:
+    functional_areas = cache["functional_areas"]
+    if functional_areas is None:
         logger.error("[get_functional_areas:error] '画面名称' column not found in the cached dataframe.")
         raise HTTPException(status_code=400, detail="'画面名称'列がファイルに見つかりません。")
-        
-    functional_areas = df["画面名称"].dropna().unique().tolist()
-    #logger.info(f"[get_functional_areas:success] Found functional areas: {functional_areas}")
+
+    #logger.info("[get_functional_areas:success] Found functional areas: %s", functional_areas)
     return functional_areas
 
 @app.get("/api/search")
 async def search_inquiries(keywords: str, functional_area: str = None):
-    logger.info(f"[search_inquiries:start] Searching for '{keywords}' in '{functional_area}'")
-    if not os.listdir(UPLOAD_DIR):
+    logger.info("[search_inquiries:start] Searching for '%s' in '%s'", keywords, functional_area)
+    if cache["filepath"] is None:
         raise HTTPException(status_code=400, detail="ファイルをアップロードしてください。")
 
-    _ensure_data_is_cached() # データがキャッシュされていることを確認
+    await _ensure_data_is_cached() # データがキャッシュされていることを確認
 
     df = cache["df"]
     vectorizer = cache["vectorizer"]
@@ -202,39 +457,55 @@ async def search_inquiries(keywords: str, functional_area: str = None):
     if df is None:
         raise HTTPException(status_code=500, detail="データがキャッシュされていません。")
 
-    # 画面名称でフィルタリング
-    target_df = df.copy()
+    # 画面名称でフィルタリング（事前に作成した行位置とマトリクス、またはマスクを使用）
+    filtered_indices = None # 対象行の位置。Noneの場合は全行が対象
+    filtered_matrix = matrix
+    filtered_mask = None
     if functional_area and functional_area != "すべて":
-        if "画面名称" in target_df.columns:
-            target_df = target_df[target_df["画面名称"] == functional_area]
-        else:
+        if "画面名称" not in df.columns:
             raise HTTPException(status_code=400, detail="'画面名称'列が見つかりません。")
+        group_indices = cache["group_indices"].get(functional_area)
+        if group_indices is None:
+            logger.info("[search_inquiries:info] No data matches the filter.")
+            return []
+        if functional_area in cache["group_matrices"]:
+            filtered_indices = group_indices
+            filtered_matrix = cache["group_matrices"][functional_area]
+        else:
+            filtered_mask = cache["group_masks"][functional_area]
+        target_count = group_indices.size
+    else:
+        target_count = len(df)
 
-    if target_df.empty:
+    if target_count == 0:
         logger.info("[search_inquiries:info] No data matches the filter.")
         return []
 
-    # フィルタリングされた行のインデックスを取得
-    filtered_indices = target_df.index.tolist()
-    
-    # 全体のTF-IDFマトリクスから、フィルタリングされた行に対応する部分をスライス
-    filtered_matrix = matrix[filtered_indices]
-
-    # 検索クエリをベクトル化
-    query_vec = vectorizer.transform([keywords])
-
-    # 類似度を計算
-    cosine_similarities = cosine_similarity(query_vec, filtered_matrix).flatten()
-
-    # 結果をデータフレームに追加
-    target_df["similarity"] = cosine_similarities
-
-    # 類似度でソート
-    results_df = target_df.sort_values(by="similarity", ascending=False).head(100)
-
-    results = results_df.to_dict(orient="records")
-    logger.info(f"[search_inquiries:success] Found {len(results)} results.")
-    return results
+    # 検索クエリをベクトル化（画面名称と一致する場合は事前に作成したベクトルを使用）
+    query_vec = cache["area_query_vectors"].get(keywords)
+    if query_vec is None:
+        query_vec = _vectorize_query(id(vectorizer), keywords)
+
+    # 類似度を計算（クエリ・マトリクスともにL2正規化済みのため、内積がコサイン類似度になる）
+    cosine_similarities = (query_vec @ filtered_matrix.T).toarray().ravel()
+    if filtered_mask is not None:
+        # 対象外の行は上位に選ばれないよう-infにする
+        cosine_similarities = np.where(filtered_mask, cosine_similarities, -np.inf)
+
+    # 全件ソートせず、argpartitionで上位100件のみ選択してからソート
+    # 類似度が同じ場合は元の行順を維持する
+    top_n = min(100, target_count)
+    top_positions = np.argpartition(cosine_similarities, -top_n)[-top_n:]
+    top_positions = top_positions[np.lexsort((top_positions, -cosine_similarities[top_positions]))]
+
+    row_positions = top_positions if filtered_indices is None else filtered_indices[top_positions]
+    results_df = df.iloc[row_positions].copy()
+    results_df["similarity"] = cosine_similarities[top_positions]
+
+    # 行ごとのdictを作らず、pandasで直接JSON文字列に変換して返す
+    payload = results_df.to_json(orient="records", force_ascii=False, date_format="iso")
+    logger.info("[search_inquiries:success] Found %d results.", len(results_df))
+    return Response(content=payload, media_type="application/json")
 
 @app.get("/health")
 def health_check():